@@ -1,3 +1,4 @@
+import hashlib
 import os
 import platform
 import shlex
@@ -5,6 +6,8 @@ import shutil
 import subprocess
 import sys
 import tarfile
+import tempfile
+from importlib import metadata
 from pathlib import Path
 from typing import Any, Optional
 
@@ -16,58 +19,177 @@ SRC_ROOT = PROJECT_ROOT / "src"
 DEFAULT_BISON_FALLBACK = "3.8.2"
 BISON_TARBALL = f"bison-{DEFAULT_BISON_FALLBACK}.tar.xz"
 BISON_URL = f"https://ftp.gnu.org/gnu/bison/{BISON_TARBALL}"
+BISON_TARBALL_SHA256 = (
+    "9bba0214ccf7f1079c5d59210045227bcf619519840ebfa80cd3849cff5a5bf2"
+)
 VENDORED_TARBALL = SRC_ROOT / "bison_bin" / "_sources" / BISON_TARBALL
 CACHE_TARBALL_DIRNAME = "bison-source-cache"
+COPY_BUFSIZE = 256 * 1024
+# Lives outside pdm's build_dir, which pdm-backend wipes before every build.
+PAYLOAD_CACHE_DIR = PROJECT_ROOT / "build" / "bison-payload-cache"
+BISON_CONFIGURE_ARGS = ["--disable-nls", "--enable-relocatable"]
+# Environment that reaches configure/make and can change the compiled payload.
+BUILD_KEY_ENV_VARS = (
+    "CC",
+    "CPP",
+    "CFLAGS",
+    "CPPFLAGS",
+    "LDFLAGS",
+    "LIBS",
+    "ARCHFLAGS",
+    "MACOSX_DEPLOYMENT_TARGET",
+)
+
+_ZIG_ARCHES = {
+    "x86_64": "x86_64",
+    "amd64": "x86_64",
+    "aarch64": "aarch64",
+    "arm64": "aarch64",
+    "i386": "x86",
+    "i486": "x86",
+    "i586": "x86",
+    "i686": "x86",
+    "x86": "x86",
+    "s390x": "s390x",
+}
+
+_LINUX_PLAT_TEMPLATE = "manylinux_2_12_{0}.manylinux2010_{0}.musllinux_1_1_{0}"
+_LINUX_PLAT_NAMES = {
+    "x86_64": _LINUX_PLAT_TEMPLATE.format("x86_64"),
+    "aarch64": _LINUX_PLAT_TEMPLATE.format("aarch64"),
+    "x86": _LINUX_PLAT_TEMPLATE.format("i686"),
+    "s390x": _LINUX_PLAT_TEMPLATE.format("s390x"),
+}
+
+# Reject absolute paths, ".." and links escaping the target (3.12+ and backports).
+_EXTRACT_KWARGS: "dict[str, Any]" = (
+    {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+)
 
 machine = platform.machine().lower()
-if machine in {"x86_64", "amd64"}:
-    zig_arch = "x86_64"
-elif machine in {"aarch64", "arm64"}:
-    zig_arch = "aarch64"
-elif machine in {"i386", "i486", "i586", "i686", "x86"}:
-    zig_arch = "x86"
-elif machine in {"s390x"}:
-    zig_arch = "s390x"
-else:
-    zig_arch = None
+zig_arch = _ZIG_ARCHES.get(machine)
+
+
+class _HashingReader:
+    def __init__(self, raw: Any) -> None:
+        self._raw = raw
+        self.hash = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._raw.read(size)
+        self.hash.update(data)
+        return data
+
+
+def _sha256(path: Path) -> str:
+    with open(path, "rb") as fh:
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(fh, "sha256").hexdigest()
+        h = hashlib.sha256()
+        for chunk in iter(lambda: fh.read(COPY_BUFSIZE), b""):
+            h.update(chunk)
+        return h.hexdigest()
+
+
+def _tarball_is_valid(path: Path) -> bool:
+    return path.exists() and _sha256(path) == BISON_TARBALL_SHA256
+
+
+def _check_digest(url: str, digest: str) -> None:
+    if digest != BISON_TARBALL_SHA256:
+        raise RuntimeError(
+            f"sha256 mismatch for {url}: expected {BISON_TARBALL_SHA256}, got {digest}"
+        )
 
 
 def _download(url: str, dest: Path) -> None:
     dest.parent.mkdir(parents=True, exist_ok=True)
     print("downloading", url)
-    resp = requests.get(url, timeout=600)
-    with open(dest, "wb") as fh:
-        fh.write(resp.content)
+    with requests.get(url, stream=True, timeout=600) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True
+        reader = _HashingReader(resp.raw)
+        with open(dest, "wb") as fh:
+            shutil.copyfileobj(reader, fh, length=COPY_BUFSIZE)
+    try:
+        _check_digest(url, reader.hash.hexdigest())
+    except RuntimeError:
+        dest.unlink()
+        raise
 
 
-def _extract(archive: Path, target: Path) -> Path:
+def _prepare_target(target: Path) -> None:
     if target.exists():
         shutil.rmtree(target)
     target.mkdir(parents=True, exist_ok=True)
-    with tarfile.open(archive, "r:*") as tf:
-        tf.extractall(target)
-        tops = {Path(member.name).parts[0] for member in tf.getmembers() if member.name}
-    roots = [target / name for name in tops if (target / name).exists()]
-    if len(roots) == 1:
-        return roots[0]
+
+
+def _unpack(tf: tarfile.TarFile, target: Path) -> Path:
+    # Single pass: getmembers() after extractall() would walk the headers again.
+    top: "str | None" = None
+    single_root = True
+    for member in tf:
+        parts = Path(member.name).parts
+        if parts:
+            if top is None:
+                top = parts[0]
+            elif parts[0] != top:
+                single_root = False
+        tf.extract(member, target, **_EXTRACT_KWARGS)
+    if single_root and top is not None:
+        return target / top
     return target
 
 
+def _extract(archive: Path, target: Path) -> Path:
+    _prepare_target(target)
+    with tarfile.open(archive, mode="r|xz", bufsize=COPY_BUFSIZE) as tf:
+        return _unpack(tf, target)
+
+
+def _stream_extract(url: str, target: Path) -> Path:
+    # Decompress and extract while downloading, without an on-disk archive.
+    # The sha256 is only known once the stream ends, so extraction relies on the
+    # "data" filter for safety; without it (older Pythons) the digest only keeps
+    # a tampered source tree from being compiled.
+    _prepare_target(target)
+    print("downloading", url)
+    with requests.get(url, stream=True, timeout=600) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True
+        reader = _HashingReader(resp.raw)
+        with tarfile.open(fileobj=reader, mode="r|xz", bufsize=COPY_BUFSIZE) as tf:
+            src_root = _unpack(tf, target)
+        # tarfile stops at the end-of-archive marker; hash the trailing bytes too.
+        while reader.read(COPY_BUFSIZE):
+            pass
+    _check_digest(url, reader.hash.hexdigest())
+    return src_root
+
+
 def _run(cmd: list[str], *, cwd: Path, env: "dict[str, str]") -> None:
     print("run: ", shlex.join(cmd))
-    subprocess.check_call(cmd, cwd=str(cwd), env=env)
+    if os.environ.get("BISON_BIN_VERBOSE") == "1":
+        subprocess.check_call(cmd, cwd=str(cwd), env=env)
+        return
+
+    # Buffer the (very chatty) configure/make output and only show it on failure.
+    proc = subprocess.run(
+        cmd, cwd=str(cwd), env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    if proc.returncode != 0:
+        print(proc.stdout.decode(errors="replace"), end="", file=sys.stderr, flush=True)
+        raise subprocess.CalledProcessError(proc.returncode, cmd, output=proc.stdout)
 
 
 def _build_tar_project(
     *,
     project: str,
-    archive: Path,
-    workdir: Path,
+    src_root: Path,
     prefix: Path,
     env: "dict[str, str]",
     extra_config: "Optional[list[str]]" = None,
 ) -> None:
-    src_root = _extract(archive, workdir)
     configure = src_root / "configure"
     if not configure.exists():
         raise RuntimeError(f"Missing configure script for {project}")
@@ -78,12 +200,13 @@ def _build_tar_project(
         config_args.extend(extra_config)
 
     _run(["bash", "./configure", *config_args], cwd=src_root, env=env)
-    _run(["make"], cwd=src_root, env=env)
-    _run(["make", "install"], cwd=src_root, env=env)
+    jobs = f"-j{os.cpu_count() or 1}"
+    _run(["make", jobs], cwd=src_root, env=env)
+    _run(["make", jobs, "install"], cwd=src_root, env=env)
 
 
 def _ensure_vendored_tarball() -> Path:
-    if VENDORED_TARBALL.exists():
+    if _tarball_is_valid(VENDORED_TARBALL):
         return VENDORED_TARBALL
 
     VENDORED_TARBALL.parent.mkdir(parents=True, exist_ok=True)
@@ -91,14 +214,48 @@ def _ensure_vendored_tarball() -> Path:
     return VENDORED_TARBALL
 
 
-def _resolve_tarball(downloads: Path) -> Path:
+def _resolve_tarball() -> "Path | None":
     if VENDORED_TARBALL.exists():
         return VENDORED_TARBALL
+    return None
+
+
+def _with_compiler_cache(env: "dict[str, str]") -> None:
+    # Reuse object files across wheel rebuilds when ccache/sccache is available.
+    for launcher, cache_dir_var in (
+        ("ccache", "CCACHE_DIR"),
+        ("sccache", "SCCACHE_DIR"),
+    ):
+        if shutil.which(launcher, path=env.get("PATH")) is not None:
+            env["CC"] = f"{launcher} {env.get('CC', 'cc')}"
+            if cache_dir_var not in env:
+                cache_dir = Path.home() / ".cache" / "bison-bin-ccache"
+                env[cache_dir_var] = str(cache_dir)
+            return
+
+
+def _compiler_env() -> "dict[str, str]":
+    env = os.environ.copy()
+    if sys.platform == "linux":
+        if zig_arch is not None:
+            env["CC"] = f"python-zig cc -target {zig_arch}-linux-musl"
+    return env
 
-    archive_path = downloads / BISON_TARBALL
-    if not archive_path.exists():
-        _download(BISON_URL, archive_path)
-    return archive_path
+
+def _compiler_identity(env: "dict[str, str]") -> str:
+    cc = env.get("CC", "cc")
+    if cc.startswith("python-zig "):
+        try:
+            return f"ziglang {metadata.version('ziglang')}"
+        except metadata.PackageNotFoundError:
+            return ""
+    try:
+        proc = subprocess.run(
+            [*shlex.split(cc), "--version"], capture_output=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+    return proc.stdout.decode(errors="replace")
 
 
 def build_bison(
@@ -106,40 +263,94 @@ def build_bison(
     install_prefix: Path,
     *,
     archive: "Path | None" = None,
+    clean: bool = True,
 ) -> Path:
-    env = os.environ.copy()
-
-    downloads = stage_root / "downloads"
     workdir = stage_root / "work"
 
-    if stage_root.exists():
+    if clean and stage_root.exists():
         shutil.rmtree(stage_root)
     workdir.mkdir(parents=True, exist_ok=True)
-    downloads.mkdir(parents=True, exist_ok=True)
 
-    env = env.copy()
+    env = _compiler_env()
+    _with_compiler_cache(env)
 
-    if sys.platform == "linux":
-        if zig_arch is not None:
-            env["CC"] = f"python-zig cc -target {zig_arch}-linux-musl"
+    archive_path = archive or _resolve_tarball()
+    if archive_path is not None and not _tarball_is_valid(archive_path):
+        # Most likely a partial download left behind by an interrupted build.
+        print("ignoring tarball with bad checksum", archive_path)
+        archive_path = None
 
-    archive_path = archive or _resolve_tarball(downloads)
+    if archive_path is not None:
+        src_root = _extract(archive_path, workdir)
+    else:
+        src_root = _stream_extract(BISON_URL, workdir)
 
     _build_tar_project(
         project="bison",
-        archive=archive_path,
-        workdir=workdir,
+        src_root=src_root,
         prefix=install_prefix,
         env=env,
-        extra_config=[
-            "--disable-nls",
-            "--enable-relocatable",
-        ],
+        extra_config=BISON_CONFIGURE_ARGS,
     )
 
     return install_prefix
 
 
+def _build_key() -> str:
+    env = _compiler_env()
+    h = hashlib.blake2b(digest_size=16)
+    for part in (
+        BISON_URL,
+        sys.platform,
+        str(zig_arch),
+        *(f"{name}={env.get(name, '')}" for name in BUILD_KEY_ENV_VARS),
+        _compiler_identity(env),
+        *BISON_CONFIGURE_ARGS,
+    ):
+        h.update(part.encode())
+        h.update(b"\0")
+    # Any change to this hook may change the payload.
+    h.update(Path(__file__).read_bytes())
+    return h.hexdigest()
+
+
+def _restore_cached_payload(payload_prefix: Path, build_key: str) -> bool:
+    # Each entry is published with a single rename, so a present one is complete.
+    cached = PAYLOAD_CACHE_DIR / build_key
+    if not (cached / "bin" / "bison").exists():
+        return False
+    try:
+        shutil.copytree(cached, payload_prefix, symlinks=True)
+    except OSError as e:
+        print("ignoring unusable bison payload cache:", e)
+        shutil.rmtree(payload_prefix, ignore_errors=True)
+        return False
+    print("reusing cached bison payload from", cached)
+    return True
+
+
+def _store_cached_payload(payload_prefix: Path, build_key: str) -> None:
+    # Best-effort: a cache that cannot be written must not fail the build.
+    tmp_dir = None
+    try:
+        PAYLOAD_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_dir = Path(tempfile.mkdtemp(prefix=".tmp-", dir=PAYLOAD_CACHE_DIR))
+        shutil.copytree(payload_prefix, tmp_dir / "payload", symlinks=True)
+        os.replace(tmp_dir / "payload", PAYLOAD_CACHE_DIR / build_key)
+    except OSError as e:
+        # Also covers a concurrent build that already published this key.
+        print("not caching bison payload:", e)
+        return
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    # Drop entries for other keys; in-progress ".tmp-*" dirs are left alone.
+    for entry in PAYLOAD_CACHE_DIR.iterdir():
+        if entry.name != build_key and not entry.name.startswith("."):
+            shutil.rmtree(entry, ignore_errors=True)
+
+
 def _default_linux_plat_name() -> "str | None":
     if not sys.platform.startswith("linux"):
         return None
@@ -147,17 +358,8 @@ def _default_linux_plat_name() -> "str | None":
     if zig_arch is None:
         return None
 
-    template = "manylinux_2_12_{0}.manylinux2010_{0}.musllinux_1_1_{0}"
-
-    plats = {
-        "x86_64": template.format("x86_64"),
-        "aarch64": template.format("aarch64"),
-        "x86": template.format("i686"),
-        "s390x": template.format("s390x"),
-    }
-
     try:
-        return plats[zig_arch]
+        return _LINUX_PLAT_NAMES[zig_arch]
     except KeyError:
         raise RuntimeError(f"No plat-name mapping for {zig_arch}") from None
 
@@ -192,25 +394,31 @@ def pdm_build_initialize(context: Context) -> None:
     stage_root = Path(context.build_dir) / "bison-stage"
     payload_prefix = Path(context.build_dir) / "bison_bin" / "_payload"
 
-    cache_tarball = Path(context.build_dir) / CACHE_TARBALL_DIRNAME / BISON_TARBALL
-    cache_tarball.parent.mkdir(parents=True, exist_ok=True)
-
+    archive: "Path | None" = None
     if VENDORED_TARBALL.exists():
-        shutil.copy(VENDORED_TARBALL, cache_tarball)
-        VENDORED_TARBALL.unlink()
+        cache_tarball = Path(context.build_dir) / CACHE_TARBALL_DIRNAME / BISON_TARBALL
+        cache_tarball.parent.mkdir(parents=True, exist_ok=True)
+        # A rename when both live on the same filesystem; falls back to copy+unlink.
+        shutil.move(str(VENDORED_TARBALL), str(cache_tarball))
         # Best-effort cleanup of empty _sources directory.
         try:
             VENDORED_TARBALL.parent.rmdir()
         except OSError:
             pass
-    elif not cache_tarball.exists():
-        _download(BISON_URL, cache_tarball)
+        archive = cache_tarball
 
-    build_bison(stage_root, payload_prefix, archive=cache_tarball)
+    # The vendored tarball is moved out of the package first, even on a cache hit.
+    use_cache = os.environ.get("BISON_BIN_NO_PAYLOAD_CACHE") != "1"
+    build_key = _build_key() if use_cache else ""
+    if use_cache and _restore_cached_payload(payload_prefix, build_key):
+        return
 
-    stage_root = Path(context.build_dir) / "bison-stage"
-    if stage_root.exists():
-        shutil.rmtree(stage_root, ignore_errors=True)
+    # build_dir was just recreated, so the stage directory is already fresh.
+    build_bison(stage_root, payload_prefix, archive=archive, clean=False)
+    if use_cache:
+        _store_cached_payload(payload_prefix, build_key)
+
+    shutil.rmtree(stage_root, ignore_errors=True)
 
 
 def pdm_build_finalize(context: Context, artifact: Path) -> None: